@@ -11,7 +11,7 @@ Repository : https://github.com/celray/ccfx
 
 # imports
 import os, sys
-import glob
+import functools
 import warnings
 from netCDF4 import Dataset
 from osgeo import gdal, ogr, osr
@@ -22,45 +22,61 @@ import platform
 import zipfile
 import pickle
 import time
+import threading
+import shapely
 from shapely.geometry import box, Point
 import geopandas, pandas
-from collections import defaultdict
+from pyproj import Transformer
+from collections import defaultdict, OrderedDict
 import py7zr
 import subprocess
 import multiprocessing
 from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, TPE1, TALB, TIT2, TRCK, TDRC, TCON, APIC, COMM, USLT, TPE2, TCOM, TPE3, TPE4, TCOP, TENC, TSRC, TBPM
-from concurrent.futures import ThreadPoolExecutor
+from mutagen.id3 import ID3, Frames, Frames_2_2, TPE1, TALB, TIT2, TRCK, TDRC, TCON, APIC, COMM, USLT, TPE2, TCOM, TPE3, TPE4, TCOP, TENC, TSRC, TBPM
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed
 import math
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 import yt_dlp
 from typing import Optional
 from datetime import datetime, timedelta
 
 # functions
-def listFiles(path: str, ext: Optional[str] = None) -> list:
+def _scanFiles(path: str, ext: Optional[str] = None):
     '''
-    List all files in a directory with a specific extension
-    path: directory
-    ext: extension (optional), variations allowed like 'txt', '.txt', '*txt', '*.txt'
+    Yield the os.DirEntry of each file in path matching ext
+    ext: extension (optional), same variations as listFiles
     '''
-
     if ext is None:
         ext = '*'
     else:
         ext = ext.lstrip('*')  
         if not ext.startswith('.'):
             ext = '.' + ext  
+        # case-insensitive on Windows, like glob
+        ext = os.path.normcase(ext)
 
-    pattern = os.path.join(path, f'*{ext}')
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # hidden files are skipped, as a '*' glob would
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            if ext == '*' or (ext == '.*' and '.' in entry.name) or os.path.normcase(entry.name).endswith(ext):
+                yield entry
 
-    if not os.path.isdir(path):
+def listFiles(path: str, ext: Optional[str] = None) -> list:
+    '''
+    List all files in a directory with a specific extension
+    path: directory
+    ext: extension (optional), variations allowed like 'txt', '.txt', '*txt', '*.txt'
+    '''
+    try:
+        return [os.path.join(path, entry.name) for entry in _scanFiles(path, ext)]
+    except (FileNotFoundError, NotADirectoryError):
         print(f'! Warning: {path} is not a directory')
         return []
 
-    return glob.glob(pattern)
-
 def getExtension(filePath:str) -> str:
     '''
     Get the extension of a file
@@ -71,6 +87,13 @@ def getExtension(filePath:str) -> str:
     return os.path.splitext(filePath)[1].lstrip('.')
 
 
+# frames getMp3Metadata needs when no artwork is requested, including the
+# ID3v2.3 date frames that make up TDRC and the ID3v2.2 equivalents
+_MP3_TEXT_FRAMES = {
+    **{frameId: Frames[frameId] for frameId in ['TPE1', 'TALB', 'TIT2', 'TRCK', 'TDRC', 'TCON', 'TYER', 'TDAT', 'TIME']},
+    **{frameId: Frames_2_2[frameId] for frameId in ['TP1', 'TAL', 'TT2', 'TRK', 'TYE', 'TDA', 'TIM', 'TCO']},
+}
+
 def getMp3Metadata(fn, imagePath=None):
     '''
     This function takes a path to mp3 and returns a dictionary with
@@ -80,33 +103,37 @@ def getMp3Metadata(fn, imagePath=None):
     metadata = {}
     
     try:
-        audio = MP3(fn, ID3=ID3)
+        if imagePath is None:
+            # only parse the text frames, artwork and the audio stream are never decoded
+            tags = ID3(fn, known_frames=_MP3_TEXT_FRAMES)
+        else:
+            tags = MP3(fn, ID3=ID3).tags
         
-        if 'TPE1' in audio.tags: metadata['artist'] = str(audio.tags['TPE1'])
+        if 'TPE1' in tags: metadata['artist'] = str(tags['TPE1'])
         else: metadata['artist'] = "Unknown Artist"
             
-        if 'TALB' in audio.tags: metadata['album'] = str(audio.tags['TALB'])
+        if 'TALB' in tags: metadata['album'] = str(tags['TALB'])
         else: metadata['album'] = "Unknown Album"
             
-        if 'TIT2' in audio.tags: metadata['title'] = str(audio.tags['TIT2'])
+        if 'TIT2' in tags: metadata['title'] = str(tags['TIT2'])
         else: metadata['title'] = os.path.basename(fn).replace('.mp3', '')
             
-        if 'TRCK' in audio.tags: metadata['track_number'] = str(audio.tags['TRCK'])
+        if 'TRCK' in tags: metadata['track_number'] = str(tags['TRCK'])
         else: metadata['track_number'] = "0"
             
-        if 'TDRC' in audio.tags: metadata['year'] = str(audio.tags['TDRC'])
+        if 'TDRC' in tags: metadata['year'] = str(tags['TDRC'])
         else: metadata['year'] = "Unknown Year"
             
-        if 'TCON' in audio.tags: metadata['genre'] = str(audio.tags['TCON'])
+        if 'TCON' in tags: metadata['genre'] = str(tags['TCON'])
         else: metadata['genre'] = "Unknown Genre"
 
         if imagePath is not None:
             foundImage = False
-            if audio.tags:
-                for tagKey in audio.tags.keys():
+            if tags:
+                for tagKey in tags.keys():
                     if tagKey.startswith("APIC:"):
                         with open(imagePath, 'wb') as img_file:
-                            img_file.write(audio.tags[tagKey].data)
+                            img_file.write(tags[tagKey].data)
                         foundImage = True
                         break
             if not foundImage:
@@ -338,6 +365,27 @@ def formatTimedelta(delta: timedelta) -> str:
         return f"{time_fmt}"
 
 
+# metadata key -> (ID3 tag, frame class) written by setMp3Metadata, later keys win on the same tag
+_MP3_TAG_MAP = {
+    'artist':       ('TPE1', TPE1),
+    'album':        ('TALB', TALB),
+    'title':        ('TIT2', TIT2),
+    'track_number': ('TRCK', TRCK),
+    'year':         ('TDRC', TDRC),
+    'genre':        ('TCON', TCON),
+    'comment':      ('COMM', COMM),
+    'lyrics':       ('USLT', USLT),
+    'publisher':    ('TPUB', TPE2),
+    'composer':     ('TCOM', TCOM),
+    'conductor':    ('TPE3', TPE3),
+    'performer':    ('TPE4', TPE4),
+    'copyright':    ('TCOP', TCOP),
+    'encoded_by':   ('TENC', TENC),
+    'encoder':      ('TENC', TENC),
+    'isrc':         ('TSRC', TSRC),
+    'bpm':          ('TBPM', TBPM),
+}
+
 def setMp3Metadata(fn, metadata, imagePath=None):
     '''
     This function takes a path to an mp3 and a metadata dictionary,
@@ -359,24 +407,9 @@ def setMp3Metadata(fn, metadata, imagePath=None):
         except:
             audio = ID3()
             
-        # Set artist
-        if 'artist' in metadata and metadata['artist']: audio['TPE1'] = TPE1(encoding=3, text=metadata['artist'])
-        if 'album' in metadata and metadata['album']: audio['TALB'] = TALB(encoding=3, text=metadata['album'])
-        if 'title' in metadata and metadata['title']: audio['TIT2'] = TIT2(encoding=3, text=metadata['title'])
-        if 'track_number' in metadata and metadata['track_number']: audio['TRCK'] = TRCK(encoding=3, text=metadata['track_number'])
-        if 'year' in metadata and metadata['year']: audio['TDRC'] = TDRC(encoding=3, text=metadata['year'])
-        if 'genre' in metadata and metadata['genre']: audio['TCON'] = TCON(encoding=3, text=metadata['genre'])
-        if 'comment' in metadata and metadata['comment']: audio['COMM'] = COMM(encoding=3, text=metadata['comment'])
-        if 'lyrics' in metadata and metadata['lyrics']: audio['USLT'] = USLT(encoding=3, text=metadata['lyrics'])
-        if 'publisher' in metadata and metadata['publisher']: audio['TPUB'] = TPE2(encoding=3, text=metadata['publisher'])
-        if 'composer' in metadata and metadata['composer']: audio['TCOM'] = TCOM(encoding=3, text=metadata['composer'])
-        if 'conductor' in metadata and metadata['conductor']: audio['TPE3'] = TPE3(encoding=3, text=metadata['conductor'])
-        if 'performer' in metadata and metadata['performer']: audio['TPE4'] = TPE4(encoding=3, text=metadata['performer'])
-        if 'copyright' in metadata and metadata['copyright']: audio['TCOP'] = TCOP(encoding=3, text=metadata['copyright'])
-        if 'encoded_by' in metadata and metadata['encoded_by']: audio['TENC'] = TENC(encoding=3, text=metadata['encoded_by'])
-        if 'encoder' in metadata and metadata['encoder']: audio['TENC'] = TENC(encoding=3, text=metadata['encoder'])
-        if 'isrc' in metadata and metadata['isrc']: audio['TSRC'] = TSRC(encoding=3, text=metadata['isrc'])
-        if 'bpm' in metadata and metadata['bpm']: audio['TBPM'] = TBPM(encoding=3, text=metadata['bpm'])
+        # Build all text frames in one pass over the tag table
+        frames = {tag: frameClass(encoding=3, text=metadata[key]) for key, (tag, frameClass) in _MP3_TAG_MAP.items() if metadata.get(key)}
+        audio.update(frames)
         # Check if image path is in metadata dictionary and not provided as parameter
         if imagePath is None and 'imagePath' in metadata:
             imagePath = metadata['imagePath']
@@ -518,13 +551,26 @@ def deletePath(path:str, v:bool = False) -> bool:
         deleted = False
 
 
-def downloadChunk(url, start, end, path):
+def downloadChunk(url, start, end, path, progress = None, idx = 0, session = None):
+    '''
+    Download the byte range start-end of url into path
+    progress: list of per-chunk byte counts, progress[idx] is updated as bytes are written (optional)
+    idx: index of this chunk in progress
+    session: requests.Session to reuse pooled connections from (optional)
+    '''
     headers = {'Range': f'bytes={start}-{end}'}
-    response = requests.get(url, headers=headers, stream=True)
+    response = (session or requests).get(url, headers=headers, stream=True)
+    # byte ranges refer to the encoded body, so copy it as sent
+    response.raw.decode_content = False
     with open(path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
+        # same loop as shutil.copyfileobj, but reporting progress per block
+        while True:
+            block = response.raw.read(1 << 20)
+            if not block:
+                break
+            f.write(block)
+            if progress is not None:
+                progress[idx] += len(block)
 
 
 def formatStringBlock(input_str, max_chars=70):
@@ -578,68 +624,127 @@ def downloadFile(url, save_path, exists_action='resume', num_connections=5, v=Fa
             os.remove(save_fname)
         # 'resume' is handled below
 
-    # Get file size
-    response = requests.head(url)
-    file_size = int(response.headers.get('content-length', 0))
-
-    # Resume download if file exists and exists_action is 'resume'
-    initial_pos = 0
-    if exists_action == 'resume' and os.path.exists(save_fname):
-        initial_pos = os.path.getsize(save_fname)
-        if initial_pos >= file_size:
-            if v:
-                print(f"File already completed: {save_fname}")
-            return
-
-    # Calculate chunk sizes
-    chunk_size = math.ceil((file_size - initial_pos) / num_connections)
-    chunks = []
-    for i in range(num_connections):
-        start = initial_pos + (i * chunk_size)
-        end = min(start + chunk_size - 1, file_size - 1)
-        chunks.append((start, end))
-
-    # Download chunks in parallel
-    temp_files = [f"{save_fname}.part{i}" for i in range(num_connections)]
-    with ThreadPoolExecutor(max_workers=num_connections) as executor:
-        futures = []
-        for i, (start, end) in enumerate(chunks):
-            futures.append(
-                executor.submit(downloadChunk, url, start, end, temp_files[i])
-            )
+    # One pooled session for the size query and every chunk, so connections are reused,
+    # closed on the way out even when a chunk fails
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_connections=num_connections, pool_maxsize=num_connections, max_retries=3)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        # Get file size
+        response = session.head(url)
+        file_size = int(response.headers.get('content-length', 0))
+
+        # Resume download if file exists and exists_action is 'resume'
+        initial_pos = 0
+        if exists_action == 'resume' and os.path.exists(save_fname):
+            initial_pos = os.path.getsize(save_fname)
+            if initial_pos >= file_size:
+                if v:
+                    print(f"File already completed: {save_fname}")
+                return
+
+        # Calculate chunk sizes
+        chunk_size = math.ceil((file_size - initial_pos) / num_connections)
+        chunks = []
+        for i in range(num_connections):
+            start = initial_pos + (i * chunk_size)
+            end = min(start + chunk_size - 1, file_size - 1)
+            chunks.append((start, end))
+
+        # Download chunks in parallel
+        temp_files = [f"{save_fname}.part{i}" for i in range(num_connections)]
+        # each worker only writes its own slot, so no lock is needed
+        progress = [0] * num_connections
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            futures = []
+            for i, (start, end) in enumerate(chunks):
+                futures.append(
+                    executor.submit(downloadChunk, url, start, end, temp_files[i], progress, i, session)
+                )
         
-        # Wait for all downloads to complete with progress bar
-        with tqdm(total=file_size-initial_pos, initial=initial_pos, unit='B', 
-                 unit_scale=True, desc=fname) as pbar:
-            completed = initial_pos
-            while completed < file_size:
-                current = sum(os.path.getsize(f) for f in temp_files if os.path.exists(f))
-                pbar.update(current - completed)
-                completed = current
+            # Wait for all downloads to complete with progress bar
+            with tqdm(total=file_size, initial=initial_pos, unit='B', 
+                     unit_scale=True, desc=fname) as pbar:
+                completed = initial_pos
+                pending = futures
+                while pending:
+                    _, pending = wait(pending, timeout=0.2)
+                    current = initial_pos + sum(progress)
+                    pbar.update(current - completed)
+                    completed = current
+
+            # surface failed chunks instead of merging an incomplete file
+            for future in futures:
+                future.result()
 
     # Merge chunks
-    with open(save_fname, 'ab' if initial_pos > 0 else 'wb') as outfile:
-        for temp_file in temp_files:
-            if os.path.exists(temp_file):
+    _mergeChunks(temp_files, save_fname, initial_pos, file_size)
+
+
+def _mergeChunks(temp_files, save_fname, offset, file_size):
+    '''
+    Copy the downloaded parts into save_fname starting at offset.
+    The copy happens in the kernel via os.copy_file_range where available,
+    otherwise it is streamed through a fixed 1 MiB buffer.
+    '''
+    fd = os.open(save_fname, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o666)
+    with open(fd, 'r+b') as outfile:
+        # anything past the resume offset is stale
+        outfile.truncate(offset)
+        if hasattr(os, 'posix_fallocate') and file_size > offset:
+            try: os.posix_fallocate(fd, offset, file_size - offset)
+            except OSError: pass
+
+        try:
+            for temp_file in temp_files:
+                if not os.path.exists(temp_file):
+                    continue
+                size = os.path.getsize(temp_file)
                 with open(temp_file, 'rb') as infile:
-                    outfile.write(infile.read())
+                    copied = 0
+                    if hasattr(os, 'copy_file_range'):
+                        try:
+                            while copied < size:
+                                n = os.copy_file_range(infile.fileno(), fd, 1 << 20, offset_dst=offset + copied)
+                                if n == 0: break
+                                copied += n
+                        except OSError:
+                            # not supported for this pair of files, finish in user space
+                            pass
+                    if copied < size:
+                        infile.seek(copied)
+                        outfile.seek(offset + copied)
+                        shutil.copyfileobj(infile, outfile, length=1 << 20)
+                        outfile.flush()
+                offset += size
                 os.remove(temp_file)
+        finally:
+            # drop any preallocated space that was not filled
+            outfile.truncate(offset)
 
 
-def mergeRasterTiles(tileList:list, outFile:str) -> str:
+def mergeRasterTiles(tileList:list, outFile:str, materialize:bool = True) -> str:
     '''
     Merge raster tiles into one raster file
     tileList: list of raster files
     outFile: output raster file
+    materialize: if False, only write a virtual mosaic (use a .vrt outFile) that
+                 references the tiles without copying any pixels (default is True)
     '''
-    gdal.Warp(outFile, tileList)
+    if not materialize:
+        vrt = gdal.BuildVRT(outFile, tileList)
+        vrt = None
+        return outFile
+
+    gdal.Warp(outFile, tileList, multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'])
     return outFile
 
-def mergeRasterFiles(tileList:list, outFile:str) -> str:
+def mergeRasterFiles(tileList:list, outFile:str, materialize:bool = True) -> str:
     '''
     this function is an alias for mergeRasterTiles
     '''
-    return mergeRasterTiles(tileList, outFile)
+    return mergeRasterTiles(tileList, outFile, materialize)
 
 
 def systemPlatform() -> str:
@@ -663,11 +768,25 @@ def fileCount(path:str = "./", extension:str = ".*", v:bool = True) -> int:
     ext: extension
     v: verbose (default is True)
     '''
-    count = len(listFiles(path, extension))
+    try:
+        count = sum(1 for _ in _scanFiles(path, extension))
+    except (FileNotFoundError, NotADirectoryError):
+        count = 0
     if v:
         print(f'> there are {count} {extension if not extension ==".*" else ""} files in {path}')
     return count
 
+_GEOTIFF_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=LZW', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+
+def _geotiffCreationOptions(outFile:str) -> list:
+    '''
+    Tiled and compressed creation options for GeoTIFF outputs
+    returns an empty list when outFile is not a GeoTIFF so other drivers are untouched
+    '''
+    if not os.path.splitext(outFile)[1].lower() in ['.tif', '.tiff']:
+        return []
+    return list(_GEOTIFF_CREATION_OPTIONS)
+
 def resampleRaster(inFile:str, outFile:str, resolution:float, dstSRS = None, resamplingMethod = 'bilinear', replaceOutput:bool = True, v:bool = True) -> str:
     '''
     Resample a raster file
@@ -711,8 +830,10 @@ def resampleRaster(inFile:str, outFile:str, resolution:float, dstSRS = None, res
         print(f'> resampling {inFile} to {outFile} at {resolution}')
     
     ds = gdal.Open(inFile)
-    if dstSRS is None: gdal.Warp(outFile, ds, xRes=resolution, yRes=resolution, resampleAlg=resamleTypes[resamplingMethod])
-    else: gdal.Warp(outFile, ds, xRes=resolution, yRes=resolution, resampleAlg=resamleTypes[resamplingMethod], dstSRS=dstSRS)
+    warpArgs = dict(multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'], warpMemoryLimit=512 * 1024 * 1024,
+                    creationOptions=_geotiffCreationOptions(outFile))
+    if dstSRS is None: gdal.Warp(outFile, ds, xRes=resolution, yRes=resolution, resampleAlg=resamleTypes[resamplingMethod], **warpArgs)
+    else: gdal.Warp(outFile, ds, xRes=resolution, yRes=resolution, resampleAlg=resamleTypes[resamplingMethod], dstSRS=dstSRS, **warpArgs)
 
     ds = None
     return outFile
@@ -749,11 +870,12 @@ def pythonVariable(filename, option, variable=None):
 
     if (option == "save") or (option == "dump"):
         createPath(os.path.dirname(filename))
-        with open(filename, 'wb') as f:
-            pickle.dump(variable, f)
+        # protocol 5 pickles numpy arrays without an extra copy, the large buffer batches the writes
+        with open(filename, 'wb', buffering=1 << 20) as f:
+            pickle.dump(variable, f, protocol=pickle.HIGHEST_PROTOCOL)
 
     if (option == "load") or (option == "open"):
-        with open(filename, "rb") as f:
+        with open(filename, "rb", buffering=1 << 20) as f:
             variable = pickle.load(f)
 
     return variable
@@ -778,19 +900,27 @@ def readFrom(filename, decode_codec = None, v=False):
     a function to read ascii files
     '''
     try:
-        if not decode_codec is None: g = open(filename, 'rb')
-        else: g = open(filename, 'r')
+        # with a codec, line endings are kept as they are in the file
+        g = open(filename, 'r', encoding=decode_codec, newline=None if decode_codec is None else '')
     except:
         print("\t! error reading {0}, make sure the file exists".format(filename))
         return
 
-    file_text = g.readlines()
-    if not decode_codec is None: file_text = [line.decode(decode_codec) for line in file_text]
+    with g:
+        file_text = g.readlines()
     if v: print("\t> read {0}".format(getFileBaseName(filename, extension=True)))
-    g.close
     return file_text
 
 
+def iterLines(filename, decode_codec = None):
+    '''
+    a generator version of readFrom that yields one line at a time
+    instead of loading the whole file
+    '''
+    with open(filename, 'r', encoding=decode_codec, newline=None if decode_codec is None else '') as g:
+        yield from g
+
+
 def pointsToGeodataframe(
     rowList,
     columnNames,
@@ -803,17 +933,16 @@ def pointsToGeodataframe(
     v = False,
     includeLatLon = True ) -> geopandas.GeoDataFrame:
     df = pandas.DataFrame(rowList, columns = columnNames)
-    geometry = [
-        Point(row[lonIndex], row[latIndex]) for row in rowList
-    ]
+    geometry = geopandas.points_from_xy(df[columnNames[lonIndex]], df[columnNames[latIndex]])
 
     if not includeLatLon:
-        colsToKeep = [col for i, col in enumerate(columnNames) if i not in (latIndex, lonIndex)]
-        df = df[colsToKeep]
+        # drop in place rather than copying the remaining columns
+        for col in {columnNames[latIndex], columnNames[lonIndex]}:
+            del df[col]
 
-    gdf = geopandas.GeoDataFrame(df, geometry = geometry)
+    # setting the crs here avoids the copy made by set_crs
+    gdf = geopandas.GeoDataFrame(df, geometry = geometry, crs = f"{auth}:{code}")
     drivers = {"gpkg": "GPKG", "shp": "ESRI Shapefile"}
-    gdf = gdf.set_crs(f"{auth}:{code}")
 
     if outShape != "":
         if v:
@@ -881,16 +1010,11 @@ def renameNetCDFvariable(input_file: str, output_file: str, old_var_name: str, n
     :param new_var_name: New name for the variable
     """
     try:
-        # Check if the variable exists in the input file using `cdo showname`
-        result = subprocess.run(
-            ["cdo", "showname", input_file],
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        # Check if the variable exists by reading the file metadata, no need to start cdo for that
+        with Dataset(input_file, 'r') as nc:
+            has_variable = old_var_name in nc.variables
         
-        # Check if the old variable name is in the output
-        if old_var_name in result.stdout:
+        if has_variable:
             # Rename the variable using `cdo chname`
             subprocess.run(
                 ["cdo", f"chname,{old_var_name},{new_var_name}", input_file, output_file],
@@ -904,11 +1028,14 @@ def renameNetCDFvariable(input_file: str, output_file: str, old_var_name: str, n
     
     except subprocess.CalledProcessError as e:
         print(f"Error: {e.stderr}")
+    except OSError as e:
+        print(f"Error: {e}")
 
 
 def compressTo7z(input_dir: str, output_file: str, compressionLevel: int = 4, excludeExt: list = None, v: bool = False) -> None:
     """
     Compresses the contents of a directory to a .7z archive with maximum compression.
+    Uses a 7-Zip executable (7zz, 7z or 7za) when one is on the PATH, otherwise py7zr.
     
     :param input_dir: Path to the directory to compress
     :param output_file: Output .7z file path
@@ -918,18 +1045,34 @@ def compressTo7z(input_dir: str, output_file: str, compressionLevel: int = 4, ex
     if excludeExt is None:
         excludeExt = []
 
-    # Create the .7z archive with LZMA2 compression
-    with py7zr.SevenZipFile(output_file, 'w', filters=[{'id': py7zr.FILTER_LZMA2, 'preset': compressionLevel}]) as archive:
-        # Add each item in the input directory, avoiding the top-level folder in the archive
-        for root, _, files in os.walk(input_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                
-                # Skip excluded file extensions
-                if any(file.endswith(ext) for ext in excludeExt):
-                    continue
-                # Add file to the archive with a relative path to avoid including the 'tmp' folder itself
-                archive.write(file_path, arcname=os.path.relpath(file_path, start=input_dir))
+    sevenZip = shutil.which('7zz') or shutil.which('7z') or shutil.which('7za')
+    if sevenZip is not None:
+        # the 7-Zip executable runs LZMA2 on all cores, py7zr only uses one
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        command = [sevenZip, 'a', '-t7z', '-m0=lzma2', f'-mx={compressionLevel}', '-mmt=on', '-bso0', '-bsp0',
+                   os.path.abspath(output_file), os.path.join(os.path.abspath(input_dir), '*')]
+        command += [f'-xr!*{ext}' for ext in excludeExt]
+        subprocess.run(command, check=True)
+    else:
+        # Create the .7z archive with LZMA2 compression
+        with py7zr.SevenZipFile(output_file, 'w', filters=[{'id': py7zr.FILTER_LZMA2, 'preset': compressionLevel}]) as archive:
+            if not excludeExt:
+                # Nothing to filter, hand whole entries to py7zr, avoiding the top-level folder in the archive
+                with os.scandir(input_dir) as entries:
+                    for entry in entries:
+                        archive.writeall(entry.path, arcname=entry.name)
+            else:
+                # Add each item in the input directory, avoiding the top-level folder in the archive
+                excludeExt = tuple(excludeExt)
+                for root, _, files in os.walk(input_dir):
+                    for file in files:
+                        # Skip excluded file extensions
+                        if file.endswith(excludeExt):
+                            continue
+                        file_path = os.path.join(root, file)
+                        # Add file to the archive with a relative path to avoid including the 'tmp' folder itself
+                        archive.write(file_path, arcname=os.path.relpath(file_path, start=input_dir))
     if v:
         print(f"compressed {input_dir} to {output_file} with compression level {compressionLevel}.")
 
@@ -1083,8 +1226,8 @@ def clipVectorByExtent(inFile: str, outFile: str, bounds: tuple) -> str:
     bounds: tuple (minx, miny, maxx, maxy)
     return: output path
     '''
-    # Load the vector file as a GeoDataFrame
-    gdf = geopandas.read_file(inFile)
+    # Load only the features whose envelope meets the extent, the filter runs in GDAL using the spatial index
+    gdf = geopandas.read_file(inFile, bbox=tuple(bounds))
     bbox = box(bounds[0], bounds[1], bounds[2], bounds[3])
     clipped = gdf.clip(bbox)
     clipped.to_file(outFile)
@@ -1120,18 +1263,22 @@ def reprojectRaster(inFile: str, outFile: str, dstProjection: str, resamplingMet
     }
     
     resampling = resampling_methods.get(resamplingMethod, gdal.GRA_Mode)
-    gdal.Warp(outFile, ds, dstSRS=dstProjection, resampleAlg=resampling)
+    gdal.Warp(outFile, ds, dstSRS=dstProjection, resampleAlg=resampling,
+              multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'], warpMemoryLimit=512 * 1024 * 1024,
+              creationOptions=_geotiffCreationOptions(outFile))
     ds = None
     
     return outFile
 
-def rasterizeRaster(inFile: str, outFile: str, targetField: str, targetResolution: float) -> str:
+def rasterizeRaster(inFile: str, outFile: str, targetField: str, targetResolution: float, allTouched: bool = False) -> str:
     '''
     Rasterizes a vector layer to a raster file
     inFile: input vector file path
     outFile: output raster file path
     targetField: the field in the vector layer to use as the raster value
     targetResolution: resolution of the output raster (in units of the vector CRS)
+    allTouched: burn every pixel a feature touches, not only those whose centre it covers,
+                so features smaller than a pixel are not lost (default is False)
     return: output raster path
     '''
     # Open the vector file
@@ -1146,7 +1293,9 @@ def rasterizeRaster(inFile: str, outFile: str, targetField: str, targetResolutio
     y_res = int((y_max - y_min) / targetResolution)
     
     # Create the raster dataset
-    target_ds = gdal.GetDriverByName('GTiff').Create(outFile, x_res, y_res, 1, gdal.GDT_Int16)
+    # tiled and compressed, blocks that stay empty are not written at all
+    target_ds = gdal.GetDriverByName('GTiff').Create(outFile, x_res, y_res, 1, gdal.GDT_Int16,
+                                                     options=_GEOTIFF_CREATION_OPTIONS + ['SPARSE_OK=TRUE'])
     target_ds.SetGeoTransform((x_min, targetResolution, 0, y_max, 0, -targetResolution))
     
     # Set the projection from the vector layer
@@ -1158,7 +1307,9 @@ def rasterizeRaster(inFile: str, outFile: str, targetField: str, targetResolutio
     band.SetNoDataValue(-999)
 
     # Rasterize the vector layer
-    gdal.RasterizeLayer(target_ds, [1], layer, options=["ATTRIBUTE=" + targetField])
+    options = ["ATTRIBUTE=" + targetField]
+    if allTouched: options.append("ALL_TOUCHED=TRUE")
+    gdal.RasterizeLayer(target_ds, [1], layer, options=options)
     
     # Close the datasets
     band = None
@@ -1175,22 +1326,20 @@ def getVectorBounds(grid_gdf: geopandas.GeoDataFrame) -> tuple:
 
     return: minx, miny, maxx, maxy
     '''
-    # Initialize min and max values with extreme values
-    minx, miny = numpy.inf, numpy.inf
-    maxx, maxy = -numpy.inf, -numpy.inf
+    minx, miny, maxx, maxy = grid_gdf.total_bounds
+    return minx, miny, maxx, maxy
 
-    # Iterate through each geometry in the GeoDataFrame
-    for geom in grid_gdf.geometry:
-        # Get bounds for each geometry (minx, miny, maxx, maxy)
-        geom_minx, geom_miny, geom_maxx, geom_maxy = geom.bounds
-        
-        # Update the global min/max for x and y
-        minx = min(minx, geom_minx)
-        miny = min(miny, geom_miny)
-        maxx = max(maxx, geom_maxx)
-        maxy = max(maxy, geom_maxy)
+def getCoordinateBounds(x, y) -> tuple:
+    '''
+    This function gets the bounds of raw coordinate arrays without building a GeoDataFrame
+    x: array-like of x coordinates (e.g. longitudes)
+    y: array-like of y coordinates (e.g. latitudes)
 
-    return minx, miny, maxx, maxy
+    return: minx, miny, maxx, maxy
+    '''
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    return numpy.nanmin(x), numpy.nanmin(y), numpy.nanmax(x), numpy.nanmax(y)
 
 def ignoreWarnings(ignore:bool = True, v:bool = False) -> None:
     '''
@@ -1236,9 +1385,10 @@ def createGrid(topLeft: list = None, bottomRight: list = None, resolution: float
     if inputShape is not None:
         # Read the shapefile and get bounds
         gdf = geopandas.read_file(inputShape)
-        gdf = gdf.to_crs(crs)
+        # reprojecting into the CRS the data is already in would only copy every geometry
+        if gdf.crs != crs:
+            gdf = gdf.to_crs(crs)
         minx, miny, maxx, maxy = gdf.total_bounds
-        reference_geometry = gdf.unary_union
     else:
         # Use provided corner coordinates [lon, lat]
         # Extract coordinates and determine actual bounds
@@ -1250,36 +1400,41 @@ def createGrid(topLeft: list = None, bottomRight: list = None, resolution: float
         maxx = max(lon1, lon2)
         miny = min(lat1, lat2)
         maxy = max(lat1, lat2)
-        reference_geometry = None
+        gdf = None
     
     # Create a grid based on the bounds and resolution
     x = numpy.arange(minx, maxx, resolution)
     y = numpy.arange(miny, maxy, resolution)
     
-    # Create polygons for each grid cell
-    polygons = []
-    for i in range(len(y)):
-        for j in range(len(x)):
-            x0, y0 = x[j], y[i]
-            x1, y1 = x0 + resolution, y0 + resolution
-            # Ensure we don't exceed the bounds
-            x1 = min(x1, maxx)
-            y1 = min(y1, maxy)
-            polygons.append(box(x0, y0, x1, y1))
+    # Create polygons for all grid cells in one vectorised call, rows of y then columns of x,
+    # building the corner arrays flat rather than as 2-D grids
+    x0 = numpy.tile(x, len(y))
+    y0 = numpy.repeat(y, len(x))
+    # Ensure we don't exceed the bounds
+    x1 = numpy.minimum(x0 + resolution, maxx)
+    y1 = numpy.minimum(y0 + resolution, maxy)
+    polygons = shapely.box(x0, y0, x1, y1)
     
     # Create a GeoDataFrame from the grid
     grid_gdf = geopandas.GeoDataFrame({'geometry': polygons}, crs=crs)
     
     # Add a column to indicate if the cell intersects with the original shapefile
-    if reference_geometry is not None:
-        grid_gdf['within'] = grid_gdf.intersects(reference_geometry)
+    if gdf is not None:
+        # probe the cell index with the input features, prepared once so their
+        # edge indexes are reused for every candidate cell instead of rebuilt per test
+        features = gdf.geometry.values
+        shapely.prepare(features)
+        _, cellIndex = grid_gdf.sindex.query(features, predicate='intersects')
+        within = numpy.zeros(len(grid_gdf), dtype=bool)
+        within[cellIndex] = True
+        grid_gdf['within'] = within
     else:
         # For coordinate-based grids, set all cells as within
         grid_gdf['within'] = True
     
     # Save the grid if path is provided
     if saveVector is not None:
-        grid_gdf.to_file(saveVector, driver="GPKG")
+        grid_gdf.to_file(saveVector, driver="GPKG", engine="pyogrio")
         print(f"Grid saved to {saveVector}")
     
     return grid_gdf
@@ -1302,13 +1457,26 @@ def listDirectories(path:str) -> list:
     return listFolders(path)
 
 
+@functools.lru_cache(maxsize=128)
+def _netcdfMetadata(ncFile:str, mtime:float) -> dict:
+    '''
+    Read the variable names and their (dimension, size) pairs of a NetCDF file once,
+    closing it again. mtime is part of the cache key so a rewritten file is read again
+    '''
+    with Dataset(ncFile, 'r') as nc:
+        return {name: tuple((dim, len(nc.dimensions[dim])) for dim in var.dimensions)
+                for name, var in nc.variables.items()}
+
+def _netcdfMetadataFor(ncFile:str) -> dict:
+    ncFile = os.path.abspath(ncFile)
+    return _netcdfMetadata(ncFile, os.path.getmtime(ncFile))
+
 def netcdfVariablesList(ncFile:str) -> list:
     '''
     List all variables in a NetCDF file
     ncFile: NetCDF file
     '''
-    nc = Dataset(ncFile)
-    return list(nc.variables.keys())
+    return list(_netcdfMetadataFor(ncFile).keys())
 
 def netcdfVariableDimensions(ncFile: str, variable: str) -> dict:
     '''
@@ -1320,25 +1488,14 @@ def netcdfVariableDimensions(ncFile: str, variable: str) -> dict:
     Returns:
     A dictionary with dimension names and their sizes (e.g., time steps or levels).
     '''
-    # Open the NetCDF file
-    nc = Dataset(ncFile)
+    variables = _netcdfMetadataFor(ncFile)
     
     # Check if the variable exists in the file
-    if variable not in nc.variables:
+    if variable not in variables:
         raise ValueError(f"Variable '{variable}' not found in {ncFile}")
     
-    # Access the variable
-    var = nc.variables[variable]
-    
-    # Get dimensions associated with the variable
-    dimensions = var.dimensions
-    
     # Create a dictionary with dimension names and their sizes
-    bands_info = {}
-    for dim in dimensions:
-        bands_info[dim] = len(nc.dimensions[dim])
-    
-    return bands_info
+    return dict(variables[variable])
 
 def netcdfExportTif(ncFile: str, variable: str, outputFile: Optional[str] = None, band: int = None, v:bool = True) -> gdal.Dataset:
     '''
@@ -1381,19 +1538,82 @@ def getFileBaseName(filePath:str, extension:bool = True) -> str:
     else:
         return os.path.splitext(baseName)[0]
 
-def netcdfAverageMap(ncFiles:list, variable:str, band:int = 1) -> numpy.ndarray:
-    sum_array = netcdfSumMaps(ncFiles, variable, band=band)
+def netcdfAverageMap(ncFiles:list, variable:str, band:int = 1, workers:int = 1) -> numpy.ndarray:
+    sum_array = netcdfSumMaps(ncFiles, variable, band=band, workers=workers)
     return sum_array / len(ncFiles)
 
-def netcdfSumMaps(ncFiles:list, variable:str, band:int = 1) -> numpy.ndarray:
+def _netcdfAddBand(sum_array:Optional[numpy.ndarray], ncFile:str, variable:str, band:int = 1) -> numpy.ndarray:
+    '''
+    Add one band of a NetCDF variable, as GDAL's netCDF driver exposes it, to sum_array
+    without going through a GDAL dataset. The band is read in row blocks that follow the
+    variable's chunking, so each decompressed chunk is added while it is still in cache
+    sum_array: float32 accumulator, created on the first call when None
+    ncFile: NetCDF file
+    variable: variable to read, the last two dimensions being y and x
+    band: 1-based band number over the remaining dimensions
+    '''
+    with Dataset(ncFile, 'r') as nc:
+        var = nc.variables[variable]
+        # raw stored values like GDAL, no masking or scale/offset
+        var.set_auto_maskandscale(False)
+        if var.ndim > 2:
+            index = tuple(numpy.unravel_index(band - 1, var.shape[:-2]))
+        elif band == 1:
+            index = ()
+        else:
+            raise ValueError(f"band {band} does not exist in 2D variable {variable}")
+
+        # GDAL returns rows north up, so flip unless the y axis is stored descending
+        yName = var.dimensions[-2]
+        yCoords = nc.variables[yName] if yName in nc.variables else None
+        flip = yCoords is None or yCoords.size < 2 or yCoords[0] < yCoords[-1]
+
+        height, width = var.shape[-2:]
+        if sum_array is None:
+            sum_array = numpy.zeros((height, width), dtype=numpy.float32)
+
+        # whole chunk rows per block, about 256k cells (1 MiB of float32) each
+        chunking = var.chunking()
+        chunkRows = 1 if chunking == 'contiguous' else chunking[-2]
+        blockRows = chunkRows * max(1, (1 << 18) // (chunkRows * max(width, 1)))
+
+        for y0 in range(0, height, blockRows):
+            y1 = min(y0 + blockRows, height)
+            data = var[index + (slice(y0, y1),)]
+            if flip:
+                rows, data = slice(height - y1, height - y0), data[::-1]
+            else:
+                rows = slice(y0, y1)
+            numpy.add(sum_array[rows], data, out=sum_array[rows], casting='unsafe')
+    return sum_array
+
+def _netcdfSumFiles(ncFiles:list, variable:str, band:int = 1) -> numpy.ndarray:
     sum_array = None
     for ncFile in ncFiles:
-        dataset = netcdfExportTif(ncFile, variable, band=band, v=False)
-        data = dataset.GetRasterBand(1)
-        data = data.ReadAsArray()
-        if sum_array is None:
-            sum_array = numpy.zeros_like(data, dtype=numpy.float32)
-        sum_array += data
+        sum_array = _netcdfAddBand(sum_array, ncFile, variable, band=band)
+    return sum_array
+
+def netcdfSumMaps(ncFiles:list, variable:str, band:int = 1, workers:int = 1) -> numpy.ndarray:
+    '''
+    Sum a band of a variable across NetCDF files
+    ncFiles: list of NetCDF files
+    variable: variable to sum
+    band: band number to sum
+    workers: number of processes to split the files over (libnetcdf is not thread
+             safe, so files are decoded in separate processes rather than threads)
+    '''
+    workers = min(workers, len(ncFiles))
+    if workers <= 1:
+        return _netcdfSumFiles(ncFiles, variable, band=band)
+
+    # each process sums its own share of the files, partial sums are reduced here
+    groups = [ncFiles[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partials = list(executor.map(_netcdfSumFiles, groups, [variable] * workers, [band] * workers))
+
+    sum_array = partials[0]
+    for partial in partials[1:]:
+        numpy.add(sum_array, partial, out=sum_array)
     return sum_array
 
 
@@ -1401,7 +1621,9 @@ def tiffWriteArray(array: numpy.ndarray, outputFile: str,
                      geoTransform: tuple = (0, 1, 0, 0, 0, -1), 
                      projection: str = 'EPSG:4326',
                      noData:float = None,
-                     v:bool = False) -> gdal.Dataset:
+                     v:bool = False,
+                     compression:Optional[str] = 'LZW',
+                     tileSize:int = 256) -> gdal.Dataset:
     '''
     Write a numpy array to a GeoTIFF file
     array         : numpy array to write
@@ -1409,9 +1631,16 @@ def tiffWriteArray(array: numpy.ndarray, outputFile: str,
     geoTransform  : GeoTransform tuple (default is (0, 1, 0, 0, 0, -1)) 
                     example: (originX, pixelWidth, 0, originY, 0, -pixelHeight)
     projection    : Projection string (default is 'EPSG:4326')
+    compression   : GeoTIFF compression, e.g. 'LZW', 'DEFLATE', 'ZSTD' or None (default is 'LZW')
+    tileSize      : tile width and height in pixels, a multiple of 16 (default is 256)
     '''
+    options = ['TILED=YES', f'BLOCKXSIZE={tileSize}', f'BLOCKYSIZE={tileSize}', 'BIGTIFF=IF_SAFER']
+    if compression:
+        # floating point predictor, the band is always written as Float32
+        options += [f'COMPRESS={compression}', 'PREDICTOR=3', 'NUM_THREADS=ALL_CPUS']
+
     driver = gdal.GetDriverByName('GTiff')
-    out_ds = driver.Create(outputFile, array.shape[1], array.shape[0], 1, gdal.GDT_Float32)
+    out_ds = driver.Create(outputFile, array.shape[1], array.shape[0], 1, gdal.GDT_Float32, options=options)
     
     # Set GeoTransform
     out_ds.SetGeoTransform(geoTransform)
@@ -1427,7 +1656,9 @@ def tiffWriteArray(array: numpy.ndarray, outputFile: str,
     if noData:
         out_band.SetNoDataValue(noData)
     
-    out_band.WriteArray(array)
+    # write whole rows of tiles so each tile is compressed once
+    for yoff in range(0, array.shape[0], tileSize):
+        out_band.WriteArray(array[yoff:yoff + tileSize], 0, yoff)
     out_band.FlushCache()
     
     if v:
@@ -1441,8 +1672,8 @@ def copyFile(source:str, destination:str, v:bool = True) -> None:
     destination: destination file
     '''
     if not exists(os.path.dirname(destination)): createPath(f"{os.path.dirname(destination)}/")
-    with open(source, 'rb') as src:
-        with open(destination, 'wb') as dest: dest.write(src.read())
+    # kernel side copy (sendfile/fcopyfile) where available, never the whole file in memory
+    shutil.copyfile(source, destination)
     
     if v: print(f'> {source} copied to \t - {destination}')
 
@@ -1456,38 +1687,27 @@ def copyDirectory(source:str, destination:str, recursive = True, v:bool = True,
     v: verbose (default is True)
     filter: list of file extensions to filter out
     '''
-    if not exists(destination): os.makedirs(destination)
-
-    itemCount = None
-    counter = 1
-
-    if recursive:
-        if len(filter) > 0:
-            itemCount = len([fn for fn in listAllFiles(source) if not getExtension(fn) in filter])
-        else:
-            itemCount = len(listAllFiles(source))
-    else:
-        if len(filter) > 0:
-            itemCount = len([fn for fn in listFiles(source) if not getExtension(fn) in filter])
-        else:
-            itemCount = len(listFiles(source))
-
-
-    for item in os.listdir(source):
-        s = os.path.join(source, item)
-        d = os.path.join(destination, item)
-        if os.path.isdir(s):
-            if recursive: copyDirectory(s, d, recursive, v, filter)
-        else:
-            if len(filter) > 0:
-                if not getExtension(s) in filter:
-                    copyFile(s, d, v = False)
-                    counter += 1
-                    if v: showProgress(counter, itemCount, f'copying {getFileBaseName(item)}\t\t', barLength=50)
-            else:
-                copyFile(s, d, v = False)
-                if v: showProgress(counter, itemCount, f'copying {getFileBaseName(item)}\t\t', barLength=50)
-                counter += 1
+    # collect the files to copy, creating the directory tree serially as we go
+    pairs = []
+    pending = [(source, destination)]
+    while pending:
+        srcDir, dstDir = pending.pop()
+        if not exists(dstDir): os.makedirs(dstDir)
+        with os.scandir(srcDir) as entries:
+            for entry in entries:
+                d = os.path.join(dstDir, entry.name)
+                if entry.is_dir():
+                    if recursive: pending.append((entry.path, d))
+                elif not getExtension(entry.path) in filter:
+                    pairs.append((entry.path, d))
+
+    # copies release the GIL while in the kernel, so threads keep several in flight
+    itemCount = len(pairs)
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        futures = {executor.submit(shutil.copyfile, s, d): s for s, d in pairs}
+        for counter, future in enumerate(as_completed(futures), start=1):
+            future.result()
+            if v: showProgress(counter, itemCount, f'copying {getFileBaseName(futures[future])}\t\t', barLength=50)
     if v:print()
 
 
@@ -1498,23 +1718,106 @@ def copyFolder(source:str, destination:str, v:bool = True) -> None:
     copyDirectory(source, destination, v=v)
 
 
+@functools.lru_cache(maxsize=128)
+def _getTransformer(srcCRS: str, dstCRS: str) -> Transformer:
+    '''
+    build (once per CRS pair) a transformer taking and returning x, y / lon, lat order
+    '''
+    return Transformer.from_crs(srcCRS, dstCRS, always_xy=True)
+
+
 def convertCoordinates(lon, lat, srcEPSG, dstCRS) -> tuple:
     """
     this function converts coordinates from one CRS to another
     
-    lon: longitude
-    lat: latitude
+    lon: longitude (a number or an array of them)
+    lat: latitude (a number or an array of them)
     srcEPSG: source CRS
     dstCRS: destination CRS
     
     return: tuple (new_lon, new_lat)
     """
-    gdf = geopandas.GeoDataFrame(geometry=[Point(lon, lat)], crs=f"{srcEPSG.upper()}")
-    gdf_converted = gdf.to_crs(dstCRS.upper())
-    new_lon, new_lat = gdf_converted.geometry.x[0], gdf_converted.geometry.y[0]
+    new_lon, new_lat = _getTransformer(srcEPSG, dstCRS).transform(lon, lat)
     return (new_lon, new_lat)
 
 
+# most recently used raster blocks, bounded by their total size in bytes
+_RASTER_BLOCK_CACHE = OrderedDict()
+_RASTER_BLOCK_CACHE_BYTES = 256 * 1024 * 1024
+_RASTER_BLOCK_CACHE_LOCK = threading.Lock()
+_rasterBlockCacheUsed = 0
+
+def _rasterCacheKey(rasterPath: str) -> tuple:
+    '''
+    identifies a raster file version so cached blocks are dropped when the file changes
+    '''
+    return (os.path.abspath(rasterPath), os.path.getmtime(rasterPath))
+
+def clearRasterCache(maxBytes: Optional[int] = None) -> None:
+    '''
+    empty the block cache used by extractRasterValue and extractRasterValues
+    maxBytes: optionally set a new size limit for the cache, 0 disables caching
+    '''
+    global _rasterBlockCacheUsed, _RASTER_BLOCK_CACHE_BYTES
+    with _RASTER_BLOCK_CACHE_LOCK:
+        _RASTER_BLOCK_CACHE.clear()
+        _rasterBlockCacheUsed = 0
+        if maxBytes is not None:
+            _RASTER_BLOCK_CACHE_BYTES = maxBytes
+
+def _rasterBlockFits(band) -> bool:
+    '''
+    whether a native block of band fits in the block cache, blocks that do not
+    (e.g. single-strip files, or any block when caching is off) are never read whole
+    '''
+    bx, by = band.GetBlockSize()
+    return bx * by * max(1, gdal.GetDataTypeSize(band.DataType) // 8) <= _RASTER_BLOCK_CACHE_BYTES
+
+def _rasterWindowValues(band, px: numpy.ndarray, py: numpy.ndarray) -> numpy.ndarray:
+    '''
+    read the values at pixels px, py without reading whole blocks: one window around
+    them when it fits in the cache budget, otherwise one pixel at a time
+    '''
+    x0, y0 = int(px.min()), int(py.min())
+    width, height = int(px.max()) - x0 + 1, int(py.max()) - y0 + 1
+    if width * height * max(1, gdal.GetDataTypeSize(band.DataType) // 8) <= _RASTER_BLOCK_CACHE_BYTES:
+        window = band.ReadAsArray(x0, y0, width, height)
+        return window[py - y0, px - x0]
+    return numpy.array([band.ReadAsArray(int(x), int(y), 1, 1)[0, 0] for x, y in zip(px, py)])
+
+def _rasterBlock(ds, cacheKey: tuple, xblk: int, yblk: int) -> numpy.ndarray:
+    '''
+    read a native block of band 1, keeping the most recently used blocks in memory
+    ds: open gdal dataset
+    cacheKey: key from _rasterCacheKey for the dataset's file
+    xblk, yblk: block column and row
+    '''
+    global _rasterBlockCacheUsed
+    key = cacheKey + (xblk, yblk)
+    with _RASTER_BLOCK_CACHE_LOCK:
+        block = _RASTER_BLOCK_CACHE.get(key)
+        if block is not None:
+            _RASTER_BLOCK_CACHE.move_to_end(key)
+            return block
+
+    # read outside the lock so other threads are not held up by the I/O
+    band = ds.GetRasterBand(1)
+    bx, by = band.GetBlockSize()
+    xoff, yoff = xblk * bx, yblk * by
+    block = band.ReadAsArray(xoff, yoff, min(bx, ds.RasterXSize - xoff), min(by, ds.RasterYSize - yoff))
+
+    with _RASTER_BLOCK_CACHE_LOCK:
+        # blocks bigger than the whole cache are not kept
+        if key in _RASTER_BLOCK_CACHE or block.nbytes > _RASTER_BLOCK_CACHE_BYTES:
+            return block
+        _RASTER_BLOCK_CACHE[key] = block
+        _rasterBlockCacheUsed += block.nbytes
+        while _rasterBlockCacheUsed > _RASTER_BLOCK_CACHE_BYTES:
+            _, dropped = _RASTER_BLOCK_CACHE.popitem(last=False)
+            _rasterBlockCacheUsed -= dropped.nbytes
+    return block
+
+
 def extractRasterValue(rasterPath: str, lat: float, lon: float, coordProj: str = 'EPSG:4326') -> float:
     """
     Extract raster value at given coordinates.
@@ -1544,8 +1847,8 @@ def extractRasterValue(rasterPath: str, lat: float, lon: float, coordProj: str =
     
     # Get geotransform parameters and calculate pixel coordinates
     geotransform = ds.GetGeoTransform()
-    px = int((x - geotransform[0]) / geotransform[1])
-    py = int((y - geotransform[3]) / geotransform[5])
+    px = math.floor((x - geotransform[0]) / geotransform[1])
+    py = math.floor((y - geotransform[3]) / geotransform[5])
     
     # Check if within bounds
     if px < 0 or px >= ds.RasterXSize or py < 0 or py >= ds.RasterYSize:
@@ -1553,13 +1856,77 @@ def extractRasterValue(rasterPath: str, lat: float, lon: float, coordProj: str =
         ds = None
         return None
     
-    # Get value at pixel
-    value = ds.GetRasterBand(1).ReadAsArray(px, py, 1, 1)[0][0]
+    # Get value at pixel from its (cached) native block, or on its own if the block is too big to cache
+    band = ds.GetRasterBand(1)
+    if _rasterBlockFits(band):
+        bx, by = band.GetBlockSize()
+        block = _rasterBlock(ds, _rasterCacheKey(rasterPath), px // bx, py // by)
+        value = block[py % by, px % bx]
+    else:
+        value = band.ReadAsArray(px, py, 1, 1)[0, 0]
     ds = None
     
     return float(value)
 
 
+def extractRasterValues(rasterPath: str, lats, lons, coordProj: str = 'EPSG:4326') -> numpy.ndarray:
+    """
+    Extract raster values at many coordinates at once.
+    
+    Args:
+        rasterPath (str): Path to the raster file
+        lats (array-like): Latitudes of the points
+        lons (array-like): Longitudes of the points
+        coordProj (str): Projection of input coordinates (default: 'EPSG:4326')
+    
+    Returns:
+        numpy.ndarray: Raster values at the specified coordinates, NaN for points outside the raster
+    """
+    if not exists(rasterPath): raise ValueError(f"Raster file not found: {rasterPath}")
+    
+    ds = gdal.Open(rasterPath)
+    if ds is None: raise ValueError(f"Could not open raster file: {rasterPath}")
+    
+    raster_proj = ds.GetProjection()
+    if not raster_proj:
+        raise ValueError("Raster has no projection information")
+    
+    # Transform all points at once
+    x, y = _getTransformer(coordProj, raster_proj).transform(numpy.asarray(lons, dtype=float), numpy.asarray(lats, dtype=float))
+    
+    geotransform = ds.GetGeoTransform()
+    px = numpy.floor((numpy.atleast_1d(x) - geotransform[0]) / geotransform[1]).astype(int)
+    py = numpy.floor((numpy.atleast_1d(y) - geotransform[3]) / geotransform[5]).astype(int)
+    
+    values = numpy.full(px.shape, numpy.nan)
+    inside = (px >= 0) & (px < ds.RasterXSize) & (py >= 0) & (py < ds.RasterYSize)
+    if not inside.all():
+        print(f"! {int((~inside).sum())} point(s) are outside raster bounds")
+    
+    if inside.any():
+        # Visit points block by block so every native block is decoded only once
+        band = ds.GetRasterBand(1)
+        bx, by = band.GetBlockSize()
+        fits = _rasterBlockFits(band)
+        cacheKey = _rasterCacheKey(rasterPath)
+        idx = numpy.flatnonzero(inside)
+        xblk, yblk = px[idx] // bx, py[idx] // by
+        order = numpy.lexsort((xblk, yblk))
+        idx, xblk, yblk = idx[order], xblk[order], yblk[order]
+        breaks = numpy.flatnonzero((numpy.diff(xblk) != 0) | (numpy.diff(yblk) != 0)) + 1
+        for group in numpy.split(numpy.arange(len(idx)), breaks):
+            xb, yb = int(xblk[group[0]]), int(yblk[group[0]])
+            points = idx[group]
+            if not fits:
+                values[points] = _rasterWindowValues(band, px[points], py[points])
+                continue
+            block = _rasterBlock(ds, cacheKey, xb, yb)
+            values[points] = block[py[points] - yb * by, px[points] - xb * bx]
+    ds = None
+    
+    return values
+
+
 def getRasterValue(rasterPath: str, lat: float, lon: float, coordProj: str = 'EPSG:4326') -> float:
     '''
     this function is a wrapper for extractRasterValue
@@ -1593,26 +1960,36 @@ def showProgress(count: int, end: int, message: str, barLength: int = 100) -> No
         print()
 
 
-def listAllFiles(folder, extension="*"):
-    list_of_files = []
-    # Getting the current work directory (cwd)
-    thisdir = folder
-
-    # r=root, d=directories, f = files
-    for r, d, f in os.walk(thisdir):
-        for file in f:
-            if extension == "*":
-                list_of_files.append(os.path.join(r, file))
-            elif "." in extension:
-                if file.endswith(extension[1:]):
-                    list_of_files.append(os.path.join(r, file))
-                    # print(os.path.join(r, file))
-            else:
-                if file.endswith(extension):
-                    list_of_files.append(os.path.join(r, file))
-                    # print(os.path.join(r, file))
+def _walkFiles(folder, extension="*"):
+    '''
+    Recursively yield file paths under folder in os.walk order, using scandir entries directly
+    extension: "*" for all files, otherwise a suffix the file name has to end with
+    '''
+    suffix = extension[1:] if "." in extension else extension
+    try:
+        entries = os.scandir(folder)
+    except OSError:
+        return
 
-    return list_of_files
+    subDirs = []
+    with entries:
+        for entry in entries:
+            try:
+                isDir = entry.is_dir()
+            except OSError:
+                isDir = False
+            if isDir:
+                # like os.walk, symlinked directories are not followed
+                if not entry.is_symlink(): subDirs.append(entry.path)
+            elif extension == "*" or entry.name.endswith(suffix):
+                yield entry.path
+
+    for subDir in subDirs:
+        yield from _walkFiles(subDir, extension)
+
+
+def listAllFiles(folder, extension="*"):
+    return list(_walkFiles(folder, extension))
 
 
 def clipFeatures(inputFeaturePath:str, boundaryFeature:str, outputFeature:str, keepOnlyTypes = None, v = False) -> geopandas.GeoDataFrame:
@@ -1621,16 +1998,17 @@ def clipFeatures(inputFeaturePath:str, boundaryFeature:str, outputFeature:str, k
     
     '''
     mask_gdf = geopandas.read_file(boundaryFeature)
-    input_gdf = geopandas.read_file(inputFeaturePath)
+    # only load input features whose bounding boxes overlap the mask (reprojected to the input CRS by geopandas)
+    input_gdf = geopandas.read_file(inputFeaturePath, bbox=mask_gdf, engine="pyogrio")
 
     outDir = os.path.dirname(outputFeature)
     createPath(f"{outDir}/")
     out_gdf = input_gdf.clip(mask_gdf.to_crs(input_gdf.crs))
 
     if not keepOnlyTypes is None:
-        out_gdf = out_gdf[out_gdf.geometry.apply(lambda x : x.type in keepOnlyTypes)]
+        out_gdf = out_gdf[out_gdf.geom_type.isin(keepOnlyTypes)]
 
-    out_gdf.to_file(outputFeature)
+    out_gdf.to_file(outputFeature, engine="pyogrio")
 
     if v:
         print("\t  - clipped feature to " + outputFeature)
@@ -1739,16 +2117,29 @@ def calculateTimeseriesStats(data:pandas.DataFrame, observed:Optional[str] = Non
 
     # Calculate statistics with error handling
     try:
+        # Shared reductions, each array pass is done once and reused by the metrics below
+        n = len(obs)
+        obs_sum = numpy.sum(obs)
+        obs_mean = obs_sum / n
+        sim_mean = numpy.mean(sim)
+        obs_anomaly = obs - obs_mean
+        sim_anomaly = sim - sim_mean
+        error = sim - obs
+        obs_ss = numpy.dot(obs_anomaly, obs_anomaly)
+        sim_ss = numpy.dot(sim_anomaly, sim_anomaly)
+        error_ss = numpy.dot(error, error)
+
         # Nash-Sutcliffe Efficiency (NSE)
-        denominator = numpy.sum((obs - numpy.mean(obs)) ** 2)
-        nse = 1 - numpy.sum((obs - sim) ** 2) / denominator if denominator != 0 else numpy.nan
+        nse = 1 - error_ss / obs_ss if obs_ss != 0 else numpy.nan
 
         # Kling-Gupta Efficiency (KGE) components
-        r = numpy.corrcoef(obs, sim)[0, 1]
-        obs_std = numpy.std(obs)
-        sim_std = numpy.std(sim)
-        obs_mean = numpy.mean(obs)
-        sim_mean = numpy.mean(sim)
+        obs_std = numpy.sqrt(obs_ss / n)
+        sim_std = numpy.sqrt(sim_ss / n)
+        # Pearson r from the anomalies above, clipped like numpy.corrcoef
+        if obs_std * sim_std != 0:
+            r = numpy.clip(numpy.dot(obs_anomaly, sim_anomaly) / (n * obs_std * sim_std), -1, 1)
+        else:
+            r = numpy.nan
         
         alpha = sim_std / obs_std if obs_std != 0 else numpy.nan
         beta = sim_mean / obs_mean if obs_mean != 0 else numpy.nan
@@ -1760,30 +2151,30 @@ def calculateTimeseriesStats(data:pandas.DataFrame, observed:Optional[str] = Non
             kge = numpy.nan
 
         # Percent Bias (PBIAS)
-        pbias = 100 * numpy.sum(sim - obs) / numpy.sum(obs) if numpy.sum(obs) != 0 else numpy.nan
+        pbias = 100 * numpy.sum(error) / obs_sum if obs_sum != 0 else numpy.nan
 
         # Log Nash-Sutcliffe Efficiency (LNSE)
         eps = 0.0001
         log_obs = numpy.log(obs + eps)
         log_sim = numpy.log(sim + eps)
-        log_denominator = numpy.sum((log_obs - numpy.mean(log_obs)) ** 2)
-        lnse = 1 - numpy.sum((log_obs - log_sim) ** 2) / log_denominator if log_denominator != 0 else numpy.nan
+        log_anomaly = log_obs - numpy.mean(log_obs)
+        log_error = log_obs - log_sim
+        log_denominator = numpy.dot(log_anomaly, log_anomaly)
+        lnse = 1 - numpy.dot(log_error, log_error) / log_denominator if log_denominator != 0 else numpy.nan
 
         # R-squared (R2)
         r2 = r ** 2 if not numpy.isnan(r) else numpy.nan
 
-        # Root Mean Square Error (RMSE)
-        rmse = numpy.sqrt(numpy.mean((obs - sim) ** 2))
+        # Mean Square Error (MSE) and Root Mean Square Error (RMSE)
+        mse = error_ss / n
+        rmse = numpy.sqrt(mse)
 
         # Mean Absolute Error (MAE)
-        mae = numpy.mean(numpy.abs(obs - sim))
-
-        # Mean Square Error (MSE)
-        mse = numpy.mean((obs - sim) ** 2)
+        mae = numpy.sum(numpy.abs(error)) / n
 
         # Mean Absolute Percentage Error (MAPE)
         with numpy.errstate(divide='ignore', invalid='ignore'):
-            mape = numpy.mean(numpy.abs((obs - sim) / obs) * 100)
+            mape = numpy.mean(numpy.abs(error / obs) * 100)
             mape = numpy.nan if numpy.isinf(mape) else mape
 
     except Exception as e:
@@ -10,27 +10,126 @@ Date    : 2023-07-20
 '''
 
 # imports
+import os
 import sys
+import csv
 import sqlite3
 import sys
+import functools
+import contextlib
+import itertools
 import pandas
 
+# set CCFX_QUIET=1 to silence the progress messages of every connection
+_QUIET = os.environ.get("CCFX_QUIET") == "1"
+
+# helpers
+@functools.lru_cache(maxsize=256)
+def _insertSQL(table_name, columns = None, count = 0):
+    '''
+    INSERT statement for the given column names, or for count positional values when columns is None
+    '''
+    if columns is None:
+        return f"INSERT INTO {table_name} VALUES ({','.join('?' * count)})"
+    return f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+@functools.lru_cache(maxsize=256)
+def _selectSQL(table_name, columns):
+    '''
+    SELECT statement for already validated column names, quoted as identifiers
+    '''
+    fields = ",".join('"' + column.replace('"', '""') + '"' for column in columns)
+    return f"SELECT {fields} from {table_name}"
+
+@functools.lru_cache(maxsize=256)
+def _updateSQL(table_name, col_name, col_where):
+    return f"UPDATE {table_name} SET {col_name} = ? WHERE {col_where} = ?"
+
 # classes
 class sqliteConnection:
-    def __init__(self, sqlite_database, connect = False):
+    # applied on connect to file databases, WAL lets readers and the writer proceed
+    # together and synchronous=NORMAL drops the fsync on every commit
+    default_pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 30000,
+        'temp_store': 'MEMORY',
+        'cache_size': -65536,
+    }
+
+    def __init__(self, sqlite_database, connect = False, quiet = False, **pragmas):
+        '''
+        sqlite_database: path to the database file
+        connect: connect straight away
+        quiet: do not print progress messages (also set by the CCFX_QUIET=1 environment variable)
+        pragmas: override default_pragmas, e.g. journal_mode = 'DELETE', or None to leave one at the sqlite default
+        '''
         self.db_name = sqlite_database
+        self.quiet = quiet or _QUIET
         self.connection = None
         self.cursor = None
+        self.pragmas = {**self.default_pragmas, **pragmas}
+        self._transaction_depth = 0
+        self._schema_cache = {}
+        # keys insertDictPartial already found missing from a table, so they only trigger one schema refresh
+        self._absent_keys = {}
 
         if connect:
             self.connect()
 
     def connect(self, v=True):
-        self.connection = sqlite3.connect(self.db_name)
+        # keep more compiled statements around than the default 128
+        self.connection = sqlite3.connect(self.db_name, cached_statements=256)
+        if not self.db_name in (":memory:", ""):
+            for pragma, value in self.pragmas.items():
+                if value is not None:
+                    # e.g. journal_mode=WAL cannot be set on a read-only database, which stays readable
+                    try:
+                        self.connection.execute(f"PRAGMA {pragma}={value}")
+                    except sqlite3.Error as e:
+                        self.report("\t! could not set " + pragma + " on " + self.db_name + ": " + str(e))
         self.cursor = self.connection.cursor()
         if v:
             self.report("\t-> connection to " + self.db_name + " established...")
 
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        run several writes as one transaction, committed on exit and rolled back
+        if an exception is raised. insertDict and insertDictPartial do not commit
+        inside the block, so the whole batch costs a single commit
+
+            with db.transaction():
+                for row in rows: db.insertDictPartial("table", row)
+
+        nested blocks run in a savepoint, so an exception leaving an inner block
+        undoes only the inner writes and the outer block may carry on
+        '''
+        savepoint = None
+        if self._transaction_depth == 0:
+            if not self.connection.in_transaction:
+                self.connection.execute("BEGIN IMMEDIATE")
+        else:
+            savepoint = f"ccfx_{self._transaction_depth}"
+            self.connection.execute(f"SAVEPOINT {savepoint}")
+        self._transaction_depth += 1
+        try:
+            yield self
+        except:
+            self._transaction_depth -= 1
+            if savepoint is None:
+                self.connection.rollback()
+            else:
+                self.connection.execute(f"ROLLBACK TO {savepoint}")
+                self.connection.execute(f"RELEASE {savepoint}")
+            raise
+        else:
+            self._transaction_depth -= 1
+            if savepoint is None:
+                self.connection.commit()
+            else:
+                self.connection.execute(f"RELEASE {savepoint}")
+
     def updateValue(self, table_name, col_name, new_value, col_where1, val_1, v=False):
         """
         Updates a single value in a specified table where the condition matches.
@@ -45,8 +144,7 @@ class sqliteConnection:
         """
         try:
             # Use parameterized queries for ALL cases to prevent SQL injection
-            query = f"UPDATE {table_name} SET {col_name} = ? WHERE {col_where1} = ?"
-            self.cursor.execute(query, (new_value, val_1))
+            self.cursor.execute(_updateSQL(table_name, col_name, col_where1), (new_value, val_1))
             
             if v:
                 self.report(f"\t -> updated value in {self.db_name} table: {table_name}")
@@ -63,6 +161,7 @@ class sqliteConnection:
         try:
             self.cursor.execute('''CREATE TABLE ''' + table_name +
                                 '(' + initial_field_name + ' ' + data_type + ')')
+            self.invalidateSchema(table_name)
             self.report("\t-> created table " + table_name + " in " + self.db_name)
         except:
             self.report("\t! table exists")
@@ -73,17 +172,16 @@ class sqliteConnection:
         """
         self.cursor.execute("ALTER TABLE " + old_table_name +
                             " RENAME TO " + new_table_name)
+        self.invalidateSchema(old_table_name)
+        self.invalidateSchema(new_table_name)
         if v:
             self.report("\t-> renamed " + old_table_name + " to " + new_table_name)
         self.commitChanges()
 
     def tableExists(self, table_name):
-        self.cursor.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='{table_name}'".format(
-            table_name=table_name))
-        if self.cursor.fetchone()[0] == 1:
-            return True
-        else:
-            return False
+        # bound name, so one compiled statement serves every table and quotes in names are safe
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=? LIMIT 1", (table_name,))
+        return self.cursor.fetchone() is not None
 
     def deleteRows(self, table_to_clean, col_where=None, col_where_value=None, v=False):
         """
@@ -108,6 +206,7 @@ class sqliteConnection:
         this function deletes the specified table
         """
         self.cursor.execute('''DROP TABLE ''' + table_name)
+        self.invalidateSchema(table_name)
         self.report("\t-> deleted table " + table_name + " from " + self.db_name)
     
     def dropTable(self, table_name):
@@ -115,60 +214,82 @@ class sqliteConnection:
 
     def undoChanges(self):
         """
-        This function reverts the database to status before last commit
+        This function reverts the database to status before last commit.
+        The rollback closes the open transaction, nothing is committed afterwards
         """
-        self.report("\t-> undoing changes to " + self.db_name + " then saving")
+        self.report("\t-> undoing changes to " + self.db_name)
         self.connection.rollback()
-        self.commitChanges()
+        # rolled back DDL may have changed any table
+        self.invalidateSchema()
 
     def readTableAsDict(self, table_name, key_column = 'id'):
         # Execute a SQL query to fetch all rows from your table
-        self.cursor = self.connection.execute(f"SELECT * FROM {table_name}")
+        cursor = self.connection.execute(f"SELECT * FROM {table_name}")
 
-        # Fetch all rows as dictionaries
-        rows = [dict(zip([column[0] for column in self.cursor.description], row)) for row in self.cursor.fetchall()]
+        # Column names are the same for every row, look them up once
+        columns = [column[0] for column in cursor.description]
 
-        # Convert the list of dictionaries to a dictionary of dictionaries, 
-        # using the 'id' field as the key
-        data = {row[key_column]: row for row in rows}
+        # Build a dictionary of row dictionaries straight from the cursor,
+        # using the key_column field as the key
+        rows = (dict(zip(columns, row)) for row in cursor)
+        return {row[key_column]: row for row in rows}
 
-        return data
+    def invalidateSchema(self, table_name = None):
+        '''
+        forget the cached columns of table_name, or of all tables when None.
+        called by the methods here that change a schema, call it after
+        altering tables through your own SQL
+        '''
+        if table_name is None:
+            self._schema_cache.clear()
+            self._absent_keys.clear()
+        else:
+            self._schema_cache.pop(table_name, None)
+            self._absent_keys.pop(table_name, None)
+
+    def _tableSchema(self, table_name):
+        # column names and types of a table, read with PRAGMA table_info once and cached
+        schema = self._schema_cache.get(table_name)
+        if schema is None:
+            self.cursor.execute(f'PRAGMA table_info({table_name})')
+            schema = {row[1]: row[2] for row in self.cursor.fetchall()}
+            # a missing table is not remembered, it may be created later
+            if schema: self._schema_cache[table_name] = schema
+        return schema
 
     def getColumnsWithTypes(self, table_name):
-        c = self.cursor
-
-        # Prepare and execute a PRAGMA table_info statement
-        c.execute(f'PRAGMA table_info({table_name})')
-
-        # Fetch all rows and extract the column names and types
-        columns_with_types = {row[1]: row[2] for row in c.fetchall()}
+        return dict(self._tableSchema(table_name))
 
-        return columns_with_types
-
-    def insertDictPartial(self, table_name, data_dict):
-        c = self.cursor
-
-        # Get the column names from the table
-        c.execute(f"PRAGMA table_info({table_name})")
-        columns = [row[1] for row in c.fetchall()]
+    def insertDictPartial(self, table_name, data_dict, autocommit = True):
+        '''
+        insert the items of data_dict that match columns of the table
+        autocommit: commit straight away, set to False to batch several calls into one commit
+        '''
+        # Get the column names from the table, reading them again the first time a key
+        # is not in the cached schema, the table may have been altered outside this class
+        columns = self._tableSchema(table_name)
+        absent = self._absent_keys.get(table_name, set())
+        new_keys = [k for k in data_dict if not k in columns and not k in absent]
+        if new_keys:
+            self.invalidateSchema(table_name)
+            columns = self._tableSchema(table_name)
+            absent.update(k for k in new_keys if not k in columns)
+            self._absent_keys[table_name] = absent
 
         # Filter the dictionary keys to match the column names
         filtered_data = {k: v for k, v in data_dict.items() if k in columns}
 
-        # Prepare an INSERT INTO statement
-        fields = ', '.join(filtered_data.keys())
-        placeholders = ', '.join('?' for _ in filtered_data)
-        values = list(filtered_data.values())
-        sql = f'INSERT INTO {table_name} ({fields}) VALUES ({placeholders})'
-
-        # Execute the statement
-        c.execute(sql, values)
+        # Execute the INSERT INTO statement for these columns
+        self.cursor.execute(_insertSQL(table_name, tuple(filtered_data)), list(filtered_data.values()))
 
         # Commit the changes
-        self.commitChanges()
+        if autocommit and self._transaction_depth == 0:
+            self.commitChanges()
 
 
     def report(self, string, printing=False):
+        if self.quiet:
+            return
         if printing:
             print(f"\t> {string}")
         else:
@@ -176,33 +297,75 @@ class sqliteConnection:
             sys.stdout.flush()
 
 
-    def createTableFromDict(self, table_name, columns_with_types):
-
+    def createTableFromDict(self, table_name, columns_with_types, commit = True):
+        '''
+        commit: commit straight away, set to False when the caller commits, e.g. inside transaction()
+        '''
         # Prepare a CREATE TABLE statement
         fields = ', '.join(f'{column} {data_type}' for column, data_type in columns_with_types.items())
         sql = f'CREATE TABLE IF NOT EXISTS {table_name} ({fields})'
 
         # Execute the statement
         self.connection.execute(sql)
-        self.commitChanges()
+        self.invalidateSchema(table_name)
+        if commit and self._transaction_depth == 0:
+            self.commitChanges()
 
+    def createTablesFromDict(self, tables):
+        '''
+        create several tables in one transaction, so there is a single commit for all of them
 
-    def insertDict(self, table_name, data):
-        
-        # Prepare an INSERT INTO statement for each dictionary
-        for id, row in data.items():
-            fields = ', '.join(row.keys())
-            placeholders = ', '.join('?' for _ in row)
-            values = list(row.values())
-            sql = f'INSERT INTO {table_name} ({fields}) VALUES ({placeholders})'
+        tables: {table_name: {column: data_type, ...}, ...}
+        '''
+        with self.transaction():
+            for table_name, columns_with_types in tables.items():
+                self.createTableFromDict(table_name, columns_with_types, commit = False)
 
-            # Execute the statement
-            self.cursor.execute(sql, values)
+
+    def insertDict(self, table_name, data, autocommit = True):
+        '''
+        insert a dictionary of row dictionaries
+        autocommit: commit straight away, set to False to batch several calls into one commit
+        '''
+        # One executemany per run of consecutive rows sharing the same keys,
+        # so a uniform dict of dicts goes in as a single batch, in order
+        for keys, rows in itertools.groupby(data.values(), key=tuple):
+            self.connection.executemany(_insertSQL(table_name, keys), (tuple(row.values()) for row in rows))
 
         # Commit the changes
-        self.connection.commit()
+        if autocommit and self._transaction_depth == 0:
+            self.connection.commit()
+
+
+
+    def iterTableColumns(self, table_name, column_list="all"):
+        """
+        same as readTableColumns, but returns the cursor so rows can be
+        iterated one at a time instead of being held in a list
+
+        for row in db.iterTableColumns("table", ["id", "name"]): ...
+        """
+        if column_list == "all":
+            return self.connection.execute(
+                "SELECT * from " + table_name)
 
+        # only real columns of the table are accepted, so nothing else can be spliced into the SQL.
+        # names match case-insensitively like sqlite identifiers, and may already be "quoted"
+        schema = self._tableSchema(table_name)
+        if not schema:
+            raise ValueError(f"table {table_name} does not exist in {self.db_name}")
+        canonical = {column.casefold(): column for column in schema}
+        columns, unknown = [], []
+        for column in column_list:
+            name = column[1:-1].replace('""', '"') if len(column) > 1 and column[0] == column[-1] == '"' else column
+            if name.casefold() in canonical:
+                columns.append(canonical[name.casefold()])
+            else:
+                unknown.append(column)
+        if unknown:
+            raise ValueError(f"column(s) {', '.join(unknown)} not found in table {table_name}")
 
+        return self.connection.execute(_selectSQL(table_name, tuple(columns)))
 
     def readTableColumns(self, table_name, column_list="all"):
         """
@@ -211,20 +374,47 @@ class sqliteConnection:
 
         "all" to select all columns
         """
-        if column_list == "all":
-            self.cursor = self.connection.execute(
-                "SELECT * from " + table_name)
-        else:
-            self.cursor = self.connection.execute(
-                "SELECT " + ",".join(column_list) + " from " + table_name)
-
-        list_of_tuples = []
-        for row in self.cursor:
-            list_of_tuples.append(row)
-        self.cursor = self.connection.cursor()
+        list_of_tuples = self.iterTableColumns(table_name, column_list).fetchall()
         self.report("\t-> read selected table columns from " + table_name)
         return list_of_tuples
 
+    def registerUDF(self, name, arity, fn, deterministic = False):
+        """
+        register a scalar function that can be used in SQL run on this connection
+
+        name  : name the function is called by in SQL
+        arity : number of arguments the function takes
+        fn    : python function; compiled with numbsql (numba) when it is installed
+                and fn carries type annotations, otherwise registered as a plain callback
+        deterministic : set to True only when fn always returns the same result for the
+                same arguments, sqlite may then factor out calls and allow fn in indexes
+
+        def clamp(x: Optional[float], lo: float, hi: float) -> Optional[float]:
+            return None if x is None else min(max(x, lo), hi)
+
+        db.registerUDF("clamp", 3, clamp, deterministic = True)
+        db.query("SELECT clamp(value, 0, 100) FROM readings")
+        """
+        try:
+            import numbsql
+            numbsql.create_function(self.connection, name, arity, numbsql.sqlite_udf(fn), deterministic = deterministic)
+            return True
+        except ImportError:
+            pass
+        except Exception as e:
+            self.report(f"\t! could not compile {name} with numbsql, using a python callback: {e}")
+
+        self.connection.create_function(name, arity, fn, deterministic = deterministic)
+        return False
+
+    def query(self, sql, params = ()):
+        """
+        run a SELECT and return all rows, e.g. with functions added through registerUDF
+
+        params : values bound to the ? placeholders in sql
+        """
+        return self.connection.execute(sql, params).fetchall()
+
     def insertField(self, table_name, field_name, data_type, to_new_line=False, messages=True):
         """
         This will insert a new field into your sqlite database
@@ -235,6 +425,7 @@ class sqliteConnection:
         """
         self.cursor.execute("alter table " + table_name +
                             " add column " + field_name + " " + data_type)
+        self.invalidateSchema(table_name)
         if messages:
             if to_new_line:
                 self.report(
@@ -244,21 +435,31 @@ class sqliteConnection:
                     "\r\t-> inserted into table {0} field {1}            ".format(table_name, field_name))
                 sys.stdout.flush()
 
+    def insertFields(self, table_name, fields, messages=True):
+        """
+        Insert several new fields into your sqlite database in one transaction
+
+        table_name: an existing table
+        fields    : list of (field_name, data_type) tuples, e.g. [('area', 'real'), ('name', 'text')]
+        """
+        with self.transaction():
+            for field_name, data_type in fields:
+                self.cursor.execute("alter table " + table_name +
+                                    " add column " + field_name + " " + data_type)
+        self.invalidateSchema(table_name)
+        if messages:
+            self.report("\t-> inserted into table {0} {1} fields".format(table_name, len(fields)))
+
     def insertRow(self, table_name, ordered_content_list = [], dictionary_obj = {}, messages=False):
         """
         ordered_list such as ['ha','he','hi']
         list should have data as strings
         """
         if len(ordered_content_list) > 0:
-            values_placeholder = ','.join(['?' if value is None else '?' for value in ordered_content_list])
-            values = [None if value is None else value for value in ordered_content_list]
-            self.cursor.execute("INSERT INTO " + table_name + " VALUES(" + values_placeholder + ")", values)
+            self.cursor.execute(_insertSQL(table_name, count=len(ordered_content_list)), list(ordered_content_list))
         
         elif len(dictionary_obj) > 0:
-            question_marks = ','.join(list('?'*len(dictionary_obj)))
-            keys = ','.join(dictionary_obj.keys())
-            values = tuple(dictionary_obj.values())
-            self.cursor.execute('INSERT INTO '+table_name+' ('+keys+') VALUES ('+question_marks+')', values)
+            self.cursor.execute(_insertSQL(table_name, tuple(dictionary_obj)), tuple(dictionary_obj.values()))
 
         if messages:
             self.report("\t-> inserted row into " + table_name)
@@ -267,24 +468,100 @@ class sqliteConnection:
         """
         list_of_tuples such as [('ha','he','hi')'
                                 ('ha','he','hi')]
-        not limited to string data
+        not limited to string data, any iterable of rows (e.g. a generator) can be
+        given and is streamed into a single executemany without building a list
         """
-        self.cursor.executemany('INSERT INTO ' + table_name + ' VALUES (?{qmarks})'.format(
-            qmarks=",?" * (len(list_of_tuples[0]) - 1)), list_of_tuples)
+        rows = iter(list_of_tuples)
+        first_row = next(rows, None)
+        if first_row is None:
+            return
+
+        # the placeholder string is built from the first row's width only
+        self.connection.executemany(_insertSQL(table_name, count=len(first_row)), itertools.chain((first_row,), rows))
         if messages:
             self.report("\t-> inserted rows into " + table_name)
 
-    def dumpCSV(self, table_name, file_name, index=False, v=False):
+    def insertDataFrame(self, table_name, df, chunk = 10000, index = False, messages = False):
+        """
+        insert the rows of a pandas DataFrame into an existing table, columns matched by name,
+        in one transaction and with one executemany per chunk of rows
+
+        df    : DataFrame whose column names are columns of table_name
+        chunk : number of rows handed to each executemany
+        index : also insert the index, as a column named after it
+        """
+        frame = df.reset_index() if index else df
+
+        # sqlite3 cannot bind pandas timestamps or missing-value markers, convert those columns only
+        converted = {}
+        for column in frame.columns:
+            dtype = frame[column].dtype
+            if pandas.api.types.is_datetime64_any_dtype(dtype):
+                converted[column] = frame[column].map(lambda t: None if pandas.isna(t) else t.isoformat(sep=" "))
+            elif pandas.api.types.is_extension_array_dtype(dtype):
+                converted[column] = frame[column].astype(object).where(frame[column].notna(), None)
+        if converted:
+            frame = frame.assign(**{str(column): values for column, values in converted.items()})
+
+        sql = _insertSQL(table_name, tuple(str(column) for column in frame.columns))
+        with self.transaction():
+            for start in range(0, len(frame), chunk):
+                self.connection.executemany(sql, frame.iloc[start:start + chunk].itertuples(index=False, name=None))
+
+        if messages:
+            self.report("\t-> inserted {0} rows into {1}".format(len(frame), table_name))
+
+    def _dumpCSVArrow(self, table_name, file_name, index=False):
+        # column-at-a-time export through ADBC and pyarrow, False when they are not installed
+        try:
+            import adbc_driver_sqlite.dbapi as adbc
+            import pyarrow
+            import pyarrow.csv
+        except ImportError:
+            return False
+
+        with adbc.connect(self.db_name) as arrow_conn:
+            with arrow_conn.cursor() as arrow_cursor:
+                arrow_cursor.execute("SELECT * FROM {tn}".format(tn=table_name))
+                table = arrow_cursor.fetch_arrow_table()
+
+        if index:
+            table = table.add_column(0, "", pyarrow.array(range(table.num_rows), type=pyarrow.int64()))
+        pyarrow.csv.write_csv(table, file_name)
+        return True
+
+    def dumpCSV(self, table_name, file_name, index=False, v=False, engine="csv"):
         '''
-        save table to csv
+        save table to csv, streaming rows from the cursor in batches
+        engine: "csv" (default) or "arrow" to read the table column-wise through
+                adbc_driver_sqlite and write it with pyarrow (which quotes strings and
+                formats numbers its own way). The arrow engine opens the database file
+                separately, so it only sees committed changes, and falls back to "csv"
+                when those packages are not installed
         '''
-        tmp_conn = sqlite3.connect(self.db_name)
-        df = pandas.read_sql_query(
-            "SELECT * FROM {tn}".format(tn=table_name), tmp_conn)
-        if index:
-            df.to_csv(file_name)
-        else:
-            df.to_csv(file_name, index=False)
+        if engine == "arrow" and not self.db_name in (":memory:", ""):
+            if self._dumpCSVArrow(table_name, file_name, index):
+                if v:
+                    self.report(
+                        "\t-> dumped table {0} to {1}".format(table_name, file_name))
+                return
+            self.report("\t! adbc_driver_sqlite and pyarrow are needed for the arrow engine, using csv", printing=True)
+
+        cursor = self.connection.execute("SELECT * FROM {tn}".format(tn=table_name))
+        header = [column[0] for column in cursor.description]
+
+        with open(file_name, "w", newline="", encoding="utf-8", buffering=1 << 20) as csv_file:
+            writer = csv.writer(csv_file, lineterminator=os.linesep)
+            writer.writerow([""] + header if index else header)
+            row_number = 0
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                if index:
+                    rows = [(row_number + i,) + tuple(row) for i, row in enumerate(rows)]
+                    row_number += len(rows)
+                writer.writerows(rows)
 
         if v:
             self.report(
@@ -306,6 +583,13 @@ class sqliteConnection:
         '''
         if commit:
             self.commitChanges()
+        if not self.db_name in (":memory:", ""):
+            # refresh planner statistics and fold the WAL back into the database file
+            try:
+                self.connection.execute("PRAGMA optimize")
+                self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                self.report("\t! could not optimise " + self.db_name + " before closing: " + str(e))
         self.connection.close()
         self.report("\t-> closed connection to " + self.db_name)
 